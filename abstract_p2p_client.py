@@ -1,28 +1,71 @@
 import os
+import sys
+import mmap
 import struct
-from time import sleep
-from threading import Thread, Lock
+import itertools
+from time import sleep, monotonic
+from collections import deque
+from queue import Queue, LifoQueue, Empty, Full
+from threading import Thread, Lock, Event, BoundedSemaphore, current_thread
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 
-from protocol import Protocol
+from protocol import Protocol, IncompletePacketError
+from received_file import ReceivedFile
+
+
+_CHUNK_INDEX = struct.Struct('<L')
+_MESSAGE_ID = struct.Struct('<L')
+_HAS_GIL = getattr(sys, '_is_gil_enabled', lambda: True)() # Free-threaded builds (3.13+) can run the framing threads in parallel
 
 
 class AbstractP2PClient(ABC):
     CHUNK_SIZE = 1024
     ACK_ARRIVAL_TIME = 0.5
-    WAIT_BEFORE_FILE_STREAM_RELEASE = 4
+    RETRANSMIT_CHECK_INTERVAL = 0.1
+    FILE_RECEIVED_TIMEOUT = 20 * ACK_ARRIVAL_TIME # Release a file stream anyway if the other end doesn't report the file was received (counted from when all of its chunks were acked)
+    MAX_RECEIVE_SIZE = 64 * 1024
+    MAX_HANDLED_BYTES_IN_BUFFER = 64 * 1024
+    MAX_PACKETS_PER_SEND = 100
+    SEND_WINDOW_SIZE = 256 # Reliable packets that can be sent before their ACKs arrive
+    PACKET_POOL_SIZE = 128
+    FRAMING_BATCH_SIZE = 64 # File chunks that are read and then wrapped in parallel
 
     FILE_TRANSFER_STREAMS = [7771, 7772, 7773, 7774]
 
     def __init__(self, peer):
         self._peer = peer
-        self._next_message_id = 0
-        self._message_id_to_was_acked = {} # Check if reliable messages were acked or not
-        self._messages_ids_that_have_been_received = {} # In order to avoid executing the same command twice due to retransmit
-        self._file_stream_id_to_chunks = {stream_id:{} for stream_id in self.FILE_TRANSFER_STREAMS} # This is for RECEIVING on a file stream. Every chunk is saved in a dictionary when the key the chunk's index.
-        self._file_stream_id_to_is_available = {stream_id:True for stream_id in self.FILE_TRANSFER_STREAMS} # This is for SENDING on a file stream
-        self._file_streams_lock = Lock()
-        Thread(target=self._listen).start()
+        self._message_ids = itertools.count(1)
+        self._outstanding = {} # Reliable packets that weren't acked yet: message_id -> [packet, retransmit deadline (None while waiting to be sent), holds a window slot]
+        self._outstanding_lock = Lock()
+        self._send_window = BoundedSemaphore(self.SEND_WINDOW_SIZE)
+        # In order to avoid executing the same command twice due to retransmit. Message ids are sequential, so only the ids above the highest contiguous one are kept.
+        self._received_message_ids_watermark = 0 # Every id up to it was received
+        self._received_message_ids_above_watermark = set()
+        self._file_stream_id_to_received_file = {} # This is for RECEIVING on a file stream. Created when the first chunk of a file arrives.
+        self._file_stream_id_to_number_of_chunks = {stream_id:None for stream_id in self.FILE_TRANSFER_STREAMS} # Known only when the last chunk arrives
+        self._file_stream_id_to_all_chunks_arrived = {stream_id:Event() for stream_id in self.FILE_TRANSFER_STREAMS}
+        self._file_stream_id_to_file_was_received = {stream_id:Event() for stream_id in self.FILE_TRANSFER_STREAMS} # This is for SENDING on a file stream, set when the other end handled the file
+        self._file_stream_id_to_sent_file_id = {stream_id:None for stream_id in self.FILE_TRANSFER_STREAMS} # This is for SENDING on a file stream, the message id of the file's first chunk (the other end reports it back)
+        self._available_file_streams = Queue() # This is for SENDING on a file stream
+        for stream_id in self.FILE_TRANSFER_STREAMS:
+            self._available_file_streams.put(stream_id)
+
+        self._outbound = Queue() # (packet, message_id) that wait to be sent by the flush thread, message_id is None for unreliable packets
+        self._packet_pool = LifoQueue(maxsize=self.PACKET_POOL_SIZE) # Buffers for file chunk packets, reused once the chunks are acked
+        self._packet_buffer_size = Protocol.RELIABLE_STREAM_OVERHEAD + _CHUNK_INDEX.size + 1 + self.CHUNK_SIZE # Fits a full chunk's packet
+        self._packet_type_to_handler = { # The handlers get the fields that were unwrapped for their packet type
+            0: self._handle_reliable,
+            1: self.on_unreliable_message,
+            2: self._handle_reliable_stream,
+            3: self.on_unreliable_stream_message,
+            4: self._handle_ack,
+        }
+        self._framing_executor = ThreadPoolExecutor(max_workers=os.cpu_count()) if not _HAS_GIL else None # With the GIL, zlib releases it only for buffers above 5 KiB, so chunks are wrapped on the sending thread
+        self._listen_thread = Thread(target=self._listen)
+        self._listen_thread.start()
+        Thread(target=self._flush_loop).start()
+        Thread(target=self._retransmit_loop).start()
 
     @abstractmethod
     def on_reliable_message(self, message):
@@ -42,192 +85,318 @@ class AbstractP2PClient(ABC):
 
     @abstractmethod
     def on_file(self, filename, file_data):
-        pass
+        """Called when a file was received.
 
-    def _get_next_message_id(self):
-        self._next_message_id += 1
-        return self._next_message_id
-
-    @staticmethod
-    def _extract_packets(data):
-        """Extract packets from a read chunk that starts with a barker (if there was something before - it was dropped).
-        
-        Note:
-            The method assumes the data always starts with a barker
-
-        Returns:
-            list[str]: The extracted packets (the last packet might be only a part of a packet).
+        Args:
+            filename (str): the name of the sent file.
+            file_data (mmap.mmap): a read only mapping of the received data (the file was streamed to a temporary file, not kept in memory).
         """
-        barker_indexes = [0]
-        while True:
-            barker_index = data.find(Protocol.BARKER, barker_indexes[-1] + Protocol.BARKER_LENGTH)
-            if barker_index == -1:
-                break
-
-            barker_indexes.append(barker_index)
-        
-        packets = []
-        for i in range(len(barker_indexes) - 1):
-            packets.append(data[barker_indexes[i]:barker_indexes[i + 1]])
+        pass
 
-        packets.append(data[barker_indexes[-1]:]) # The rest might be a packet or a part of a packet
-        return packets
+    def _get_next_message_id(self):
+        return next(self._message_ids) # A single atomic step, unlike reading and incrementing an attribute
 
     def _lock_file_stream(self):
-        self._file_streams_lock.acquire()
-
-        available_stream_id = None
-        while available_stream_id is None:
-            for stream_id in self.FILE_TRANSFER_STREAMS:
-                if self._file_stream_id_to_is_available[stream_id]:
-                    self._file_stream_id_to_is_available[stream_id] = False
-                    available_stream_id = stream_id
-                    break
-
-        self._file_streams_lock.release()
-        return available_stream_id
+        return self._available_file_streams.get() # Blocks until a stream is released
 
     def _handle_file_send(self, file_path):
         stream_id = self._lock_file_stream()
-
+        try:
+            self._send_file_on_stream(file_path, stream_id)
+        finally:
+            self._available_file_streams.put(stream_id)
+
+    def _send_file_on_stream(self, file_path, stream_id):
+        self._file_stream_id_to_sent_file_id[stream_id] = None # A late report of the previous file is ignored
+        self._file_stream_id_to_file_was_received[stream_id].clear()
         is_last_chunk = b'0'
         filename = Protocol.str_to_bytes(os.path.basename(file_path))
         packet_index = 0
-        self.send_reliable_stream_message(struct.pack('L', packet_index) + is_last_chunk + filename, stream_id)
-        with open(file_path, 'rb') as transferred_file:
-            chunk = transferred_file.read(self.CHUNK_SIZE)
-            while chunk:
-                packet_index += 1
-                self.send_reliable_stream_message(struct.pack('L', packet_index) + is_last_chunk + chunk, stream_id)
-                chunk = transferred_file.read(self.CHUNK_SIZE)
+        message_ids = deque([self._send_file_chunk(_CHUNK_INDEX.pack(packet_index) + is_last_chunk + filename, stream_id)]) # The chunks that might not be acked yet
+        self._file_stream_id_to_sent_file_id[stream_id] = message_ids[0]
+        file_size = os.path.getsize(file_path)
+        if file_size: # An empty file can't be mapped
+            with open(file_path, 'rb') as transferred_file, mmap.mmap(transferred_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file, memoryview(mapped_file) as file_view: # The view is released before the mapping is closed
+                # Chunks are copied straight from the mapping, without reading them first
+                messages = []
+                for offset in range(0, file_size, self.CHUNK_SIZE):
+                    packet_index += 1
+                    messages.append(_CHUNK_INDEX.pack(packet_index) + is_last_chunk + file_view[offset:offset + self.CHUNK_SIZE])
+                    if len(messages) == self.FRAMING_BATCH_SIZE:
+                        message_ids.extend(self._send_file_chunks(messages, stream_id))
+                        self._discard_acked(message_ids)
+                        messages = []
+
+                message_ids.extend(self._send_file_chunks(messages, stream_id))
 
         is_last_chunk = b'1'
         packet_index += 1
-        self.send_reliable_stream_message(struct.pack('L', packet_index) + is_last_chunk, stream_id)
-
-        # Wait in order to make sure the file was received and processed at the other end (maybe adding a message that the transfer ended well is better)
-        sleep(self.WAIT_BEFORE_FILE_STREAM_RELEASE)
-        self._file_stream_id_to_is_available[stream_id] = True
-
-    def _handle_file_chunks(self, stream_id, number_of_chunks):
+        message_ids.append(self._send_file_chunk(_CHUNK_INDEX.pack(packet_index) + is_last_chunk, stream_id))
+
+        # The other end has the whole file only once every chunk was acked (they might have to be retransmitted), the stream can't be reused before that
+        while message_ids:
+            self._discard_acked(message_ids)
+            if message_ids:
+                sleep(self.RETRANSMIT_CHECK_INTERVAL)
+
+        # Wait for the other end to report that the file was received and processed, before the stream can be reused
+        if not self._file_stream_id_to_file_was_received[stream_id].wait(self.FILE_RECEIVED_TIMEOUT):
+            print('Error: The other end did not report receiving {} on stream {}, releasing the stream'.format(file_path, stream_id))
+
+    def _discard_acked(self, message_ids):
+        """Drop the acked message ids from the front of the given deque (the packets are acked roughly in the order they were sent, so it stays short)."""
+        with self._outstanding_lock:
+            while message_ids and message_ids[0] not in self._outstanding:
+                message_ids.popleft()
+
+    def _check_file_chunks_arrived(self, stream_id):
+        number_of_chunks = self._file_stream_id_to_number_of_chunks[stream_id]
+        if number_of_chunks is not None and self._file_stream_id_to_received_file[stream_id].has_all_chunks(number_of_chunks):
+            self._file_stream_id_to_all_chunks_arrived[stream_id].set()
+
+    def _handle_file_chunks(self, stream_id):
         # Wait for all the chunks to arrive (they might have to be retransmitted)
-        while len(self._file_stream_id_to_chunks[stream_id]) != number_of_chunks:
-            sleep(0.1)
+        self._file_stream_id_to_all_chunks_arrived[stream_id].wait()
+        self._file_stream_id_to_all_chunks_arrived[stream_id].clear()
+        self._file_stream_id_to_number_of_chunks[stream_id] = None
+
+        received_file = self._file_stream_id_to_received_file.pop(stream_id)
+        file_data = received_file.get_data()
+        received_file.close()
+        try:
+            self.on_file(received_file.filename, file_data)
+        finally:
+            file_was_received = b'2'
+            self.send_reliable_stream_message(_CHUNK_INDEX.pack(0) + file_was_received + _MESSAGE_ID.pack(received_file.first_message_id), stream_id) # Release the stream at the sender, the id tells which file was received
+
+    def _handle_ack(self, acked_message_id):
+        with self._outstanding_lock:
+            outstanding_packet = self._outstanding.pop(acked_message_id, None) # Might have been acked already (the message was retransmitted)
+
+        if outstanding_packet is None:
+            return
+
+        packet, _, holds_window_slot = outstanding_packet
+        if holds_window_slot:
+            self._send_window.release()
+
+        if isinstance(packet, memoryview): # Wrapped in a pooled buffer
+            self._release_packet_buffer(packet.obj)
+
+    def _is_new_reliable_message(self, message_id):
+        """Ack a reliable message and check that it wasn't handled already (in order to avoid executing the same command twice due to retransmit)."""
+        self._outbound.put((Protocol.wrap_ack(message_id), None))
+        if message_id <= self._received_message_ids_watermark or message_id in self._received_message_ids_above_watermark:
+            return False
+
+        self._received_message_ids_above_watermark.add(message_id)
+        while self._received_message_ids_watermark + 1 in self._received_message_ids_above_watermark:
+            self._received_message_ids_watermark += 1
+            self._received_message_ids_above_watermark.discard(self._received_message_ids_watermark)
+
+        return True
+
+    def _handle_reliable(self, message, message_id):
+        if self._is_new_reliable_message(message_id):
+            self.on_reliable_message(message)
+
+    def _handle_reliable_stream(self, message, message_id, stream_id):
+        if not self._is_new_reliable_message(message_id):
+            return
+
+        # Check if it's a file
+        if stream_id in self.FILE_TRANSFER_STREAMS:
+            self._handle_file_chunk(message, message_id, stream_id)
+        else:
+            self.on_reliable_stream_message(message, stream_id)
+
+    def _handle_file_chunk(self, message, message_id, stream_id):
+        chunk_index, = _CHUNK_INDEX.unpack_from(message)
+        # Check if it's the last chunk
+        is_last_chunk = message[4] # Unicode is returned
+        if is_last_chunk == 50: # ord('2'), not a chunk - the other end received the file that was sent on this stream
+            received_file_id, = _MESSAGE_ID.unpack_from(message, 5)
+            if received_file_id == self._file_stream_id_to_sent_file_id[stream_id]: # A late report of a previous file must not release the stream
+                self._file_stream_id_to_file_was_received[stream_id].set()
+            return
+
+        if is_last_chunk == 48: # ord('0')
+            is_last_chunk = False
+        elif is_last_chunk == 49: # ord('1')
+            is_last_chunk = True
+        else:
+            print('Error: Invalid unicode value for is_last_chunk: {}'.format(is_last_chunk))
+            return
+
+        if stream_id not in self._file_stream_id_to_received_file:
+            self._file_stream_id_to_received_file[stream_id] = ReceivedFile()
+
+        if chunk_index == 0:
+            self._file_stream_id_to_received_file[stream_id].first_message_id = message_id
+
+        if is_last_chunk:
+            self._file_stream_id_to_number_of_chunks[stream_id] = chunk_index
+            Thread(target=self._handle_file_chunks, args=(stream_id,)).start()
+        
+        else:
+            self._file_stream_id_to_received_file[stream_id].add_chunk(chunk_index, memoryview(message)[5:]) # 4 bytes of chunk_index and 1 byte of is_last_chunk
 
-        filename = self._file_stream_id_to_chunks[stream_id][0].decode('utf8')
+        self._check_file_chunks_arrived(stream_id)
 
-        file_data = bytearray()
-        for i in range(1, number_of_chunks):
-            file_data.extend(self._file_stream_id_to_chunks[stream_id][i])
+    def _handle_received_data(self, data, head):
+        """Handle the packets in the receive buffer, starting at the given index.
+
+        Note:
+            A packet's end is found by its data_size, so a barker inside a packet's data doesn't split it.
+            If a packet is invalid (e.g. a barker that was found inside data), the search continues from the next barker.
+            The packets are handed to the protocol as memoryviews of the buffer, so no view may outlive this method (the buffer can't be resized while it's exported).
 
-        self._file_stream_id_to_chunks[stream_id] = {}
-        self.on_file(filename, file_data)
+        Returns:
+            int: The index of the first byte that should be kept for the next read.
+        """
+        view = memoryview(data)
+        while head < len(data):
+            barker_index = data.find(Protocol.BARKER, head)
+            if barker_index == -1: # Barker not found
+                new_head = max(head, len(data) - (Protocol.BARKER_LENGTH - 1)) # Drop the bad data and make sure not to drop the beginning of a barker
+                if new_head > head:
+                    print('Bad data: {}'.format(bytes(data[head:new_head])))
+                return new_head
 
-    def _handle_unwrapped_message(self, message, message_id, stream_id, acked_message_id):
-        # Check if ACK
-        if acked_message_id:
+            # Everything before the barker is dropped
             try:
-                self._message_id_to_was_acked[acked_message_id] = True
-            except KeyError:
-                print('Got ACK on invalid message id {}'.format(acked_message_id))
-            finally:
-                return
-        
-        if message_id is None: # Unreliable
-            if stream_id is None:
-                self.on_unreliable_message(message)
+                packet_type, fields, redundant_bytes = Protocol.unwrap(view[barker_index:])
+            except IncompletePacketError:
+                return barker_index # Wait for the rest of the packet
+            except ValueError as ex:
+                print('Bad packet: {}'.format(ex))
+                head = barker_index + 1 # Look for the next barker
             else:
-                self.on_unreliable_stream_message(message, stream_id)
-
-        else: # Reliable
-            self._peer.send(Protocol.wrap_ack(message_id))
-            if message_id not in self._messages_ids_that_have_been_received: # In order to avoid executing the same command twice due to retransmit
-                self._messages_ids_that_have_been_received[message_id] = True # Could be anything (beside True). I just want to create the key
-
-                if stream_id is None:
-                    self.on_reliable_message(message)
-
-                # Check if it's a file
-                elif stream_id in self.FILE_TRANSFER_STREAMS:
-                    chunk_index, = struct.unpack('L', message[:4])
-                    # Check if it's the last chunk
-                    is_last_chunk = message[4] # Unicode is returned
-                    if is_last_chunk == 48: # ord('0')
-                        is_last_chunk = False
-                    elif is_last_chunk == 49: # ord('1')
-                        is_last_chunk = True
-                    else:
-                        print('Error: Invalid unicode value for is_last_chunk: {}'.format(is_last_chunk))
-                        return
-
-                    if is_last_chunk:
-                        Thread(target=self._handle_file_chunks, args=(stream_id, chunk_index)).start()
-                    
-                    else:
-                        self._file_stream_id_to_chunks[stream_id][chunk_index] = message[5:] # 4 bytes of chunk_index and 1 byte of is_last_chunk
-
-                else:
-                    self.on_reliable_stream_message(message, stream_id)
+                self._packet_type_to_handler[packet_type](*fields)
+                head = len(data) - len(redundant_bytes) # The redundant bytes might be the next packet
+
+        return head
 
     def _listen(self):
-        data = b''
+        data = bytearray()
+        head = 0 # Everything before this index was already handled
         while True:
-            new_data = self._peer.receive(self.CHUNK_SIZE)
+            new_data = self._peer.receive_upto(self.MAX_RECEIVE_SIZE) # Drain everything that is already buffered in a single read
             if not new_data:
                 continue
 
-            data += new_data
-            barker_index = data.find(Protocol.BARKER)
-            if barker_index == -1: # Barker not found
-                print('Bad data: {}'.format(data))
-                data = data[-(Protocol.BARKER_LENGTH - 1):] # Drop the bad data and make sure not to drop the beginning of a barker
-                continue
-
-            data = data[barker_index:] # Drop everythinbg before the barker
-            packets = self._extract_packets(data)
+            data.extend(new_data)
+            head = self._handle_received_data(data, head)
 
-            for packet in packets[:-1]: # The last one might be only a part of a packet and should be 'data'
-                try:
-                    message, message_id, stream_id, acked_message_id, redundant_bytes = Protocol.unwrap(packet)
-                    if redundant_bytes:
-                        print('Redundant bytes: {}'.format(redundant_bytes))
-                except ValueError:
-                    print('Bad packet: {}'.format(packet))
-                else:
-                    self._handle_unwrapped_message(message, message_id, stream_id, acked_message_id)
+            # Drop the handled bytes only once in a while, so the buffer is rarely shifted
+            if head > self.MAX_HANDLED_BYTES_IN_BUFFER:
+                del data[:head]
+                head = 0
 
+    def _flush_loop(self):
+        while True:
+            packets_and_message_ids = [self._outbound.get()] # Wait for the first packet
             try:
-                message, message_id, stream_id, acked_message_id, redundant_bytes = Protocol.unwrap(packets[-1])
-            except ValueError:
-                data = packets[-1] # This is probably only a part of a packet
-            else:
-                self._handle_unwrapped_message(message, message_id, stream_id, acked_message_id)
-                data = redundant_bytes # The redundant bytes might be a part of another barker    
+                while len(packets_and_message_ids) < self.MAX_PACKETS_PER_SEND:
+                    packets_and_message_ids.append(self._outbound.get_nowait())
+            except Empty:
+                pass
+
+            self._peer.send(b''.join([packet for packet, _ in packets_and_message_ids])) # Send all the waiting packets at once
+
+            # The ACK is waited for only from the moment the packet was actually sent
+            deadline = monotonic() + self.ACK_ARRIVAL_TIME
+            with self._outstanding_lock:
+                for _, message_id in packets_and_message_ids:
+                    outstanding_packet = self._outstanding.get(message_id)
+                    if outstanding_packet is not None:
+                        outstanding_packet[1] = deadline
+
+    def _retransmit_loop(self):
+        """Retransmit every reliable packet that wasn't acked in time (a single timer for all the packets)."""
+        while True:
+            sleep(self.RETRANSMIT_CHECK_INTERVAL)
+            now = monotonic()
+            with self._outstanding_lock:
+                for message_id, outstanding_packet in self._outstanding.items():
+                    packet, deadline, _ = outstanding_packet
+                    if deadline is not None and deadline <= now:
+                        self._outbound.put((bytes(packet), message_id)) # A copy, since a pooled buffer is reused as soon as it's acked
+                        outstanding_packet[1] = None # Not queued again until this copy is sent
+
+    def _send_reliable_packet(self, packet, message_id):
+        # Wait for a slot in the send window. The listen thread (a reliable message sent from a handler) can't wait, since it's the one that handles the ACKs.
+        holds_window_slot = current_thread() is not self._listen_thread
+        if holds_window_slot:
+            self._send_window.acquire()
+
+        with self._outstanding_lock:
+            self._outstanding[message_id] = [packet, None, holds_window_slot]
+
+        self._outbound.put((packet, message_id))
+
+    def _get_packet_buffer(self, packet_size):
+        try:
+            buffer = self._packet_pool.get_nowait()
+        except Empty:
+            buffer = None
+
+        if buffer is None or len(buffer) < packet_size:
+            buffer = bytearray(max(packet_size, self._packet_buffer_size)) # The pool is empty, allocate a new one
+        
+        return buffer
+
+    def _release_packet_buffer(self, buffer):
+        try:
+            self._packet_pool.put_nowait(buffer)
+        except Full:
+            pass # Enough buffers are pooled, let this one be collected
+
+    def _wrap_file_chunk(self, message, message_id, stream_id):
+        """Wrap a file chunk for a reliable stream, in a pooled buffer instead of a new packet."""
+        buffer = self._get_packet_buffer(Protocol.RELIABLE_STREAM_OVERHEAD + len(message))
+        return Protocol.wrap_reliable_stream_into(buffer, message, message_id, stream_id)
 
-    def _send_message_and_wait_for_ack(self, message, message_id):
-        self._peer.send(message)
-        sleep(self.ACK_ARRIVAL_TIME)
-        while not self._message_id_to_was_acked[message_id]:
-            self._peer.send(message)
-            sleep(self.ACK_ARRIVAL_TIME)
+    def _send_file_chunk(self, message, stream_id):
+        message_id = self._get_next_message_id()
+        self._send_reliable_packet(self._wrap_file_chunk(message, message_id, stream_id), message_id)
+        return message_id
+
+    def _send_file_chunks(self, messages, stream_id):
+        """Wrap the file chunks in parallel (mainly the crc) and send them in order.
+
+        Returns:
+            list: The message ids of the sent chunks.
+        """
+        message_ids = [self._get_next_message_id() for _ in messages] # Allocated in order, before the chunks are wrapped
+        framing_map = self._framing_executor.map if self._framing_executor else map
+        packets = framing_map(self._wrap_file_chunk, messages, message_ids, itertools.repeat(stream_id))
+        for packet, message_id in zip(packets, message_ids):
+            self._send_reliable_packet(packet, message_id)
+
+        return message_ids
 
     def send_reliable(self, message):
+        if type(message) is str:
+            message = Protocol.str_to_bytes(message) # Encoded once, before it's validated and wrapped
+
+        Protocol.validate_data_size(message) # Before taking a message id, a skipped id would hold back the other end's watermark
         message_id = self._get_next_message_id()
-        self._message_id_to_was_acked[message_id] = False
-        message = Protocol.wrap_reliable(message, message_id)
-        Thread(target=self._send_message_and_wait_for_ack(message, message_id)).start()
+        self._send_reliable_packet(Protocol.wrap_reliable(message, message_id), message_id)
 
     def send_unreliable(self, message):
-        self._peer.send(Protocol.wrap_unreliable(message))
+        self._outbound.put((Protocol.wrap_unreliable(message), None))
 
     def send_reliable_stream_message(self, message, stream_id):
+        if type(message) is str:
+            message = Protocol.str_to_bytes(message) # Encoded once, before it's validated and wrapped
+
+        Protocol.validate_data_size(message) # Before taking a message id, a skipped id would hold back the other end's watermark
         message_id = self._get_next_message_id()
-        self._message_id_to_was_acked[message_id] = False
-        message = Protocol.wrap_reliable_stream(message, message_id, stream_id)
-        Thread(target=self._send_message_and_wait_for_ack(message, message_id)).start()
+        self._send_reliable_packet(Protocol.wrap_reliable_stream(message, message_id, stream_id), message_id)
 
     def send_unreliable_stream_message(self, message, stream_id):
-        self._peer.send(Protocol.wrap_unreliable_stream(message, stream_id))
+        self._outbound.put((Protocol.wrap_unreliable_stream(message, stream_id), None))
 
     def send_file(self, file_path):
         """Send a file over a reliable stream."""
@@ -22,3 +22,15 @@ class AbstractPeer(ABC):
             bytes. the read bytes.
         """
         pass
+
+    @abstractmethod
+    def receive_upto(self, max_receive_size):
+        """Read the bytes that are already available, without waiting to fill the requested size.
+
+        Args:
+            max_receive_size (number): the maximal size to receive/read.
+
+        Returns:
+            bytes. the read bytes (might be less than max_receive_size).
+        """
+        pass
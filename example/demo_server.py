@@ -34,6 +34,17 @@ class DemoServerPeer(AbstractPeer):
         """
         return self.input_stream.read(receive_size)
 
+    def receive_upto(self, max_receive_size):
+        """Read the bytes that are already available, without waiting to fill the requested size.
+
+        Args:
+            max_receive_size (number): the maximal size to receive/read.
+
+        Returns:
+            bytes. the read bytes (might be less than max_receive_size).
+        """
+        return self.input_stream.read1(max_receive_size)
+
 
 class DemoServer(AbstractP2PClient):
     def on_reliable_message(self, message):
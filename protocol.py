@@ -1,164 +1,246 @@
-import zlib
 import struct
+from zlib import crc32
+
+
+_U32 = struct.Struct('<L') # Fixed size and byte order on every platform (native 'L' might be 8 bytes)
+_PT_RELIABLE, _PT_UNRELIABLE, _PT_RELIABLE_STREAM, _PT_UNRELIABLE_STREAM, _PT_ACK = b'\x00', b'\x01', b'\x02', b'\x03', b'\x04'
+
+# The fields between the packet type and the data, (un)packed in a single call
+_RELIABLE_FIELDS = struct.Struct('<LL') # message_id, data_size
+_UNRELIABLE_FIELDS = struct.Struct('<L') # data_size
+_RELIABLE_STREAM_FIELDS = struct.Struct('<LLL') # message_id, stream_id, data_size
+_UNRELIABLE_STREAM_FIELDS = struct.Struct('<LL') # stream_id, data_size
+_ACK_FIELDS = struct.Struct('<L') # acked_message_id
+
+
+class IncompletePacketError(ValueError):
+    """The data is the beginning of a packet, the rest of it wasn't received yet."""
+    pass
 
 
 class Protocol(object):
     BARKER = b'BADFDADF'
-    BEFORE_STUFF = b'BADFDAD'
-    AFTER_STUFF = b'BADFDADZ'
 
     BARKER_LENGTH = len(BARKER) # Right after the barker
+    FIELDS_INDEX = BARKER_LENGTH + 1 # Right after the packet type
+    RELIABLE_STREAM_OVERHEAD = FIELDS_INDEX + _RELIABLE_STREAM_FIELDS.size + 2 * _U32.size # Everything beside the data (including both crcs)
+    MAX_DATA_SIZE = 64 * 1024 # Larger messages should be sent as files (which are sent in chunks)
 
     @staticmethod
     def str_to_bytes(data):
         return bytearray(data, 'utf8')
-    
+
     @staticmethod
-    def _stuff_data(data):
-        return data.replace(Protocol.BEFORE_STUFF, Protocol.AFTER_STUFF)
-        
+    def validate_data_size(data):
+        """Make sure the data can be wrapped (the other end drops packets with larger data).
+
+        Raises:
+            ValueError: The data is larger than MAX_DATA_SIZE.
+        """
+        if type(data) is str:
+            data = Protocol.str_to_bytes(data)
+
+        if len(data) > Protocol.MAX_DATA_SIZE:
+            raise ValueError('Data is too large: {} bytes (max is {})'.format(len(data), Protocol.MAX_DATA_SIZE))
+
     @staticmethod
-    def _unstuff_data(data):
-        return data.replace(Protocol.AFTER_STUFF, Protocol.BEFORE_STUFF)
+    def _wrap_header(prefix, fields, *values):
+        """Pack the barker, packet type and fields, followed by their crc."""
+        header = prefix + fields.pack(*values)
+        return header + _U32.pack(crc32(header))
 
     @staticmethod
-    def _extract_message(data, current_index):
-        data_size, = struct.unpack('L', data[current_index:current_index + 4])
-        current_index += 4
-        stuffed_data = data[current_index:current_index + data_size]
+    def _read_fields(fields, data):
+        """Unpack the fields and check the header crc, so a corrupted data_size is never trusted.
+
+        Note:
+            A barker might appear inside another packet's data, the header crc rejects it without waiting for its data.
+        """
+        header_crc_index = Protocol.FIELDS_INDEX + fields.size
+        if len(data) < header_crc_index + _U32.size:
+            raise IncompletePacketError('Packet is too short: {} bytes'.format(len(data))) # Raised on every partial read, so the data itself isn't formatted
+
+        header_crc, = _U32.unpack_from(data, header_crc_index)
+        if header_crc != crc32(data[:header_crc_index]):
+            raise ValueError('Invalid header crc for packet: {}'.format(bytes(data[:header_crc_index + _U32.size])))
+
+        return fields.unpack_from(data, Protocol.FIELDS_INDEX)
+
+    @staticmethod
+    def _data_index(fields):
+        return Protocol.FIELDS_INDEX + fields.size + _U32.size
+
+    @staticmethod
+    def _extract_message(data, current_index, data_size):
+        """Extract the message using its data_size (the data isn't stuffed, so a barker might appear inside it).
+
+        Returns:
+            tuple(bytes, bytes): The message and the bytes that follow the packet.
+        """
+        if data_size > Protocol.MAX_DATA_SIZE:
+            raise ValueError('Invalid data size: {}'.format(data_size))
+
+        if len(data) < current_index + data_size + 4:
+            raise IncompletePacketError('Packet is too short: {} bytes'.format(len(data))) # Raised on every partial read, so the data itself isn't formatted
+
+        message = data[current_index:current_index + data_size]
         current_index += data_size
-        crc, = struct.unpack('L', data[current_index:current_index + 4])
+        crc, = _U32.unpack_from(data, current_index)
         current_index += 4
         redundant_bytes = data[current_index:]
             
         # check crc
-        if crc != zlib.crc32(stuffed_data):
-            raise ValueError('Invalid crc for packet: {}'.format(data))
+        if crc != crc32(message):
+            raise ValueError('Invalid crc for packet: {}'.format(bytes(data[:current_index])))
             
-        return Protocol._unstuff_data(stuffed_data), redundant_bytes
+        return bytes(message), redundant_bytes
 
     @staticmethod
     def wrap_reliable(data, message_id):
         """Wrap the given data with reliable protocol so it can be sent."""
         if type(data) is str:
             data = Protocol.str_to_bytes(data)
+        Protocol.validate_data_size(data)
 
-        packet_type = chr(0).encode('utf8')
-        message_id = struct.pack('L', message_id)
-        stuffed_data = Protocol._stuff_data(data)
-        data_size = struct.pack('L', len(stuffed_data))
-        crc = struct.pack('L', zlib.crc32(stuffed_data))
-        return Protocol.BARKER + packet_type + message_id + data_size + stuffed_data + crc
+        return b''.join((Protocol._wrap_header(_HDR_RELIABLE_PREFIX, _RELIABLE_FIELDS, message_id, len(data)), data, _U32.pack(crc32(data))))
 
     @staticmethod
     def _unwrap_reliable(data):
         """Wrap the given data with reliable protocol so it can be sent."""
-        current_index = Protocol.BARKER_LENGTH + 1
-        message_id, = struct.unpack('L', data[current_index:current_index + 4])
-        current_index += 4
-        message, redundant_bytes = Protocol._extract_message(data, current_index)
-        return message, message_id, None, None, redundant_bytes
+        message_id, data_size = Protocol._read_fields(_RELIABLE_FIELDS, data)
+        message, redundant_bytes = Protocol._extract_message(data, Protocol._data_index(_RELIABLE_FIELDS), data_size)
+        return (message, message_id), redundant_bytes
 
     @staticmethod
     def wrap_unreliable(data):
         """Wrap the given data with unreliable protocol so it can be sent."""
         if type(data) is str:
             data = Protocol.str_to_bytes(data)
+        Protocol.validate_data_size(data)
 
-        packet_type = chr(1).encode('utf8')
-        stuffed_data = Protocol._stuff_data(data)
-        data_size = struct.pack('L', len(stuffed_data))
-        crc = struct.pack('L', zlib.crc32(stuffed_data))
-        return Protocol.BARKER + packet_type + data_size + stuffed_data + crc
+        return b''.join((Protocol._wrap_header(_HDR_UNRELIABLE_PREFIX, _UNRELIABLE_FIELDS, len(data)), data, _U32.pack(crc32(data))))
 
     @staticmethod
     def _unwrap_unreliable(data):
-        message, redundant_bytes = Protocol._extract_message(data, Protocol.BARKER_LENGTH + 1)
-        return message, None, None, None, redundant_bytes
+        data_size, = Protocol._read_fields(_UNRELIABLE_FIELDS, data)
+        message, redundant_bytes = Protocol._extract_message(data, Protocol._data_index(_UNRELIABLE_FIELDS), data_size)
+        return (message,), redundant_bytes
 
     @staticmethod
     def wrap_reliable_stream(data, message_id, stream_id):
         """Wrap the given data with reliable protocol so it can be streamed."""
         if type(data) is str:
             data = Protocol.str_to_bytes(data)
+        Protocol.validate_data_size(data)
+
+        return b''.join((Protocol._wrap_header(_HDR_RELIABLE_STREAM_PREFIX, _RELIABLE_STREAM_FIELDS, message_id, stream_id, len(data)), data, _U32.pack(crc32(data))))
+
+    @staticmethod
+    def wrap_reliable_stream_into(buffer, data, message_id, stream_id):
+        """Wrap the given data with reliable protocol into the given buffer (instead of allocating a new packet), so it can be streamed.
 
-        packet_type = chr(2).encode('utf8')
-        message_id = struct.pack('L', message_id)
-        stream_id = struct.pack('L', stream_id)
-        stuffed_data = Protocol._stuff_data(data)
-        data_size = struct.pack('L', len(stuffed_data))
-        crc = struct.pack('L', zlib.crc32(stuffed_data))
-        return Protocol.BARKER + packet_type + message_id + stream_id + data_size + stuffed_data + crc
+        Note:
+            The buffer should be at least RELIABLE_STREAM_OVERHEAD bytes longer than the data.
+
+        Returns:
+            memoryview: The wrapped packet (the beginning of the buffer).
+        """
+        if type(data) is str:
+            data = Protocol.str_to_bytes(data)
+        Protocol.validate_data_size(data)
+
+        header_crc_index = Protocol.FIELDS_INDEX + _RELIABLE_STREAM_FIELDS.size
+        data_index = header_crc_index + _U32.size
+        crc_index = data_index + len(data)
+        packet = memoryview(buffer)[:crc_index + _U32.size]
+        packet[:Protocol.FIELDS_INDEX] = _HDR_RELIABLE_STREAM_PREFIX
+        _RELIABLE_STREAM_FIELDS.pack_into(packet, Protocol.FIELDS_INDEX, message_id, stream_id, len(data))
+        _U32.pack_into(packet, header_crc_index, crc32(packet[:header_crc_index]))
+        packet[data_index:crc_index] = data
+        _U32.pack_into(packet, crc_index, crc32(data))
+        return packet
 
     @staticmethod
     def _unwrap_reliable_stream(data):
-        current_index = Protocol.BARKER_LENGTH + 1
-        message_id, = struct.unpack('L', data[current_index:current_index + 4])
-        current_index += 4
-        stream_id, = struct.unpack('L', data[current_index:current_index + 4])
-        current_index += 4
-        message, redundant_bytes = Protocol._extract_message(data, current_index)
-        return message, message_id, stream_id, None, redundant_bytes
+        message_id, stream_id, data_size = Protocol._read_fields(_RELIABLE_STREAM_FIELDS, data)
+        message, redundant_bytes = Protocol._extract_message(data, Protocol._data_index(_RELIABLE_STREAM_FIELDS), data_size)
+        return (message, message_id, stream_id), redundant_bytes
 
     @staticmethod
     def wrap_unreliable_stream(data, stream_id):
         """Wrap the given data with unreliable protocol so it can be streamed."""
         if type(data) is str:
             data = Protocol.str_to_bytes(data)
+        Protocol.validate_data_size(data)
 
-        packet_type = chr(3).encode('utf8')
-        stream_id = struct.pack('L', stream_id)
-        stuffed_data = Protocol._stuff_data(data)
-        data_size = struct.pack('L', len(stuffed_data))
-        crc = struct.pack('L', zlib.crc32(stuffed_data))
-        return Protocol.BARKER + packet_type + stream_id + data_size + stuffed_data + crc
+        return b''.join((Protocol._wrap_header(_HDR_UNRELIABLE_STREAM_PREFIX, _UNRELIABLE_STREAM_FIELDS, stream_id, len(data)), data, _U32.pack(crc32(data))))
 
     @staticmethod
     def _unwrap_unreliable_stream(data):
-        current_index = Protocol.BARKER_LENGTH + 1
-        stream_id, = struct.unpack('L', data[current_index:current_index + 4])
-        current_index += 4
-        message, redundant_bytes = Protocol._extract_message(data, current_index)
-        return message, None, stream_id, None, redundant_bytes
+        stream_id, data_size = Protocol._read_fields(_UNRELIABLE_STREAM_FIELDS, data)
+        message, redundant_bytes = Protocol._extract_message(data, Protocol._data_index(_UNRELIABLE_STREAM_FIELDS), data_size)
+        return (message, stream_id), redundant_bytes
 
     @staticmethod
     def wrap_ack(acked_message_id):
         """Wrap the given data with unreliable protocol so it can be sent."""
-        packet_type = chr(4).encode('utf8')
-        acked_message_id = struct.pack('L', acked_message_id)
-        return Protocol.BARKER + packet_type + acked_message_id
+        return Protocol._wrap_header(_HDR_ACK_PREFIX, _ACK_FIELDS, acked_message_id) # An ack is only a header
 
     @staticmethod
     def _unwrap_ack(data):
-        current_index = Protocol.BARKER_LENGTH + 1
-        acked_message_id, = struct.unpack('L', data[current_index:current_index + 4])
-        current_index += 4
-        redundant_bytes = data[current_index:]
-        return None, None, None, acked_message_id, redundant_bytes
+        acked_message_id, = Protocol._read_fields(_ACK_FIELDS, data)
+        redundant_bytes = data[Protocol._data_index(_ACK_FIELDS):]
+        return (acked_message_id,), redundant_bytes
 
     @staticmethod
     def unwrap(data):
-        """Unwrap the given data from the protocol layer so it can be received."""
+        """Unwrap the given data from the protocol layer so it can be received.
+
+        Note:
+            The data may be a memoryview, the returned message is always a copy (bytes) of it.
+            The data should start with a packet, the bytes after it are returned as redundant_bytes.
+
+        Returns:
+            tuple(int, tuple, bytes): The packet type, the packet's fields (depend on the type) and the redundant bytes.
+
+        Raises:
+            IncompletePacketError: The data is only the beginning of a packet.
+            ValueError: The data doesn't start with a valid packet.
+        """
         if type(data) is str:
             data = Protocol.str_to_bytes(data)
 
         try:
             # Validate barker
-            if not data.startswith(Protocol.BARKER):
-                raise ValueError('Packet is missing barker: {}'.format(data))
+            if data[:Protocol.BARKER_LENGTH] != Protocol.BARKER:
+                raise ValueError('Packet is missing barker: {}'.format(bytes(data[:Protocol.BARKER_LENGTH])))
+
+            if len(data) == Protocol.BARKER_LENGTH:
+                raise IncompletePacketError('Packet is missing its type')
 
             # Get the packet type
             packet_type = data[Protocol.BARKER_LENGTH]
-            return PACKET_TYPE_TO_UNWRAPPER[packet_type](data)
-                
+            fields, redundant_bytes = PACKET_TYPE_TO_UNWRAPPER[packet_type](data)
+            return packet_type, fields, redundant_bytes
+
+        except IncompletePacketError:
+            raise
+
         except Exception as ex:
-            raise ValueError('Invalid data: {}\nError was {}'.format(data, ex))
+            raise ValueError('Invalid packet\nError was {}'.format(ex))
+
 
+# The barker and packet type that every packet starts with
+_HDR_RELIABLE_PREFIX = Protocol.BARKER + _PT_RELIABLE
+_HDR_UNRELIABLE_PREFIX = Protocol.BARKER + _PT_UNRELIABLE
+_HDR_RELIABLE_STREAM_PREFIX = Protocol.BARKER + _PT_RELIABLE_STREAM
+_HDR_UNRELIABLE_STREAM_PREFIX = Protocol.BARKER + _PT_UNRELIABLE_STREAM
+_HDR_ACK_PREFIX = Protocol.BARKER + _PT_ACK
 
 PACKET_TYPE_TO_UNWRAPPER = {
-    0: Protocol._unwrap_reliable,
-    1: Protocol._unwrap_unreliable,
-    2: Protocol._unwrap_reliable_stream,
-    3: Protocol._unwrap_unreliable_stream,
-    4: Protocol._unwrap_ack,
+    _PT_RELIABLE[0]: Protocol._unwrap_reliable,
+    _PT_UNRELIABLE[0]: Protocol._unwrap_unreliable,
+    _PT_RELIABLE_STREAM[0]: Protocol._unwrap_reliable_stream,
+    _PT_UNRELIABLE_STREAM[0]: Protocol._unwrap_unreliable_stream,
+    _PT_ACK[0]: Protocol._unwrap_ack,
 }
@@ -0,0 +1,54 @@
+import mmap
+import tempfile
+
+
+class ReceivedFile(object):
+    """A file that is received on a file stream.
+
+    The chunks that arrive in order are written straight to a temporary file, only the chunks that arrive out of order are kept in memory (until the chunks before them arrive).
+    Chunk 0 is the filename, the rest are the file's data.
+    """
+    def __init__(self):
+        self._file = tempfile.TemporaryFile() # Deleted once closed
+        self._next_chunk_index = 0
+        self._out_of_order_chunks = {}
+        self.filename = None
+        self.first_message_id = None # The message id of chunk 0, reported back to the sender to identify the file
+
+    def _write_chunk(self, chunk):
+        if self._next_chunk_index == 0:
+            self.filename = bytes(chunk).decode('utf8')
+        else:
+            self._file.write(chunk)
+
+        self._next_chunk_index += 1
+
+    def add_chunk(self, chunk_index, chunk):
+        """Save a chunk that arrived (in any order)."""
+        if chunk_index != self._next_chunk_index:
+            self._out_of_order_chunks[chunk_index] = chunk
+            return
+
+        self._write_chunk(chunk)
+        while self._next_chunk_index in self._out_of_order_chunks:
+            self._write_chunk(self._out_of_order_chunks.pop(self._next_chunk_index))
+
+    def has_all_chunks(self, number_of_chunks):
+        """Check that chunks 0 to number_of_chunks - 1 arrived."""
+        return self._next_chunk_index == number_of_chunks
+
+    def get_data(self):
+        """Map the file's data to memory (read only, without reading it).
+
+        Returns:
+            mmap.mmap: The file's data (bytes if the file is empty, since an empty file can't be mapped).
+        """
+        self._file.flush()
+        if self._file.tell() == 0:
+            return b''
+
+        return mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        """Close (and delete) the temporary file, a mapping of its data stays valid."""
+        self._file.close()